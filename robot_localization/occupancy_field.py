@@ -24,48 +24,27 @@ class OccupancyField(object):
         rclpy.spin_until_future_complete(node, self.future)
         self.map = self.future.result().map
         node.get_logger().info("map received width: {0} height: {1}".format(self.map.info.width, self.map.info.height))
-        # The coordinates of each grid cell in the map
-        X = np.zeros((self.map.info.width*self.map.info.height, 2))
+        width = self.map.info.width
+        height = self.map.info.height
+        # occupancy grids are stored in row major order, so transpose to index the cells as [i, j] (i.e. [x, y])
+        grid = np.asarray(self.map.data).reshape(height, width).T
 
-        # while we're at it let's count the number of occupied cells
-        total_occupied = 0
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    total_occupied += 1
-                X[curr, 0] = float(i)
-                X[curr, 1] = float(j)
-                curr += 1
+        # The coordinates of each grid cell in the map
+        i_coords, j_coords = np.meshgrid(np.arange(width), np.arange(height), indexing='ij')
+        X = np.column_stack((i_coords.ravel(), j_coords.ravel())).astype(np.float64)
 
         # The coordinates of each occupied grid cell in the map
-        occupied = np.zeros((total_occupied, 2))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    occupied[curr, 0] = float(i)
-                    occupied[curr, 1] = float(j)
-                    curr += 1
+        occupied = np.argwhere(grid > 0).astype(np.float64)
         node.get_logger().info("building ball tree")
-        # use super fast scikit learn nearest neighbor algorithm
+        # use super fast scikit learn nearest neighbor algorithm, querying all of the cells at once on every core
         nbrs = NearestNeighbors(n_neighbors=1,
-                                algorithm="ball_tree").fit(occupied)
+                                algorithm="ball_tree",
+                                n_jobs=-1).fit(occupied)
         node.get_logger().info("finding neighbors")
         distances, indices = nbrs.kneighbors(X)
 
         node.get_logger().info("populating occupancy field")
-        self.closest_occ = np.zeros((self.map.info.width, self.map.info.height))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                self.closest_occ[i, j] = \
-                    distances[curr][0]*self.map.info.resolution
-                curr += 1
+        self.closest_occ = distances[:, 0].reshape(width, height)*self.map.info.resolution
         self.occupied = occupied
         node.get_logger().info("occupancy field ready")
 
@@ -15,6 +15,7 @@ from rclpy.duration import Duration
 import math
 import time
 import numpy as np
+from numba import njit, prange
 from occupancy_field import OccupancyField
 from helper_functions import TFHelper
 from rclpy.qos import qos_profile_sensor_data
@@ -56,6 +57,49 @@ class Particle(object):
         self.x += delta_dist*np.cos(self.theta)
         self.y += delta_dist*np.sin(self.theta)
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _laser_weights(xs, ys, thetas, r, theta, log_likelihood_grid, ox, oy, res, off_map_log_likelihood, out):
+    """ Compute the likelihood field weight exp(sum(log likelihood of each reading)) of each particle into out
+        xs, ys, thetas: the particle poses in the map frame
+        r, theta: the (finite) laser readings in the robot frame
+        log_likelihood_grid: the log likelihood of a reading ending in each map cell, indexed as grid[ix, iy]
+        ox, oy, res: the map origin and resolution
+        off_map_log_likelihood: the log likelihood of a reading that falls off the map
+        out: the array to write the weights to (one entry per particle)
+        The log weights are shifted by their maximum before exponentiating so that they can't all underflow to 0. """
+    n = xs.shape[0]
+    m = r.shape[0]
+    width = log_likelihood_grid.shape[0]
+    height = log_likelihood_grid.shape[1]
+    for i in prange(n):
+        log_w = 0.0
+        for j in range(m):
+            angle = thetas[i] + theta[j]
+            ix = int((xs[i] + r[j]*np.cos(angle) - ox)/res)
+            iy = int((ys[i] + r[j]*np.sin(angle) - oy)/res)
+            if ix >= 0 and iy >= 0 and ix < width and iy < height:
+                log_w += log_likelihood_grid[ix, iy]
+            else:
+                log_w += off_map_log_likelihood
+        out[i] = log_w
+    max_log_w = out.max()
+    for i in prange(n):
+        out[i] = np.exp(out[i] - max_log_w)
+
+@njit(fastmath=True, cache=True)
+def _odom_step(xs, ys, thetas, theta1, dist, theta2, noise, turn_sigma, drive_sigma):
+    """ Apply the turn, drive, turn odometry motion model to every particle in place
+        xs, ys, thetas: the particle poses, which are modified in place
+        theta1, dist, theta2: the first turn, the drive distance and the second turn
+        noise: a (3, n) array of standard normal draws for the first turn, the drive and the second turn
+        turn_sigma, drive_sigma: the standard deviation of the turn and drive noise """
+    for i in range(xs.shape[0]):
+        thetas[i] += theta1 + noise[0, i]*turn_sigma
+        d = dist + noise[1, i]*drive_sigma
+        xs[i] += d*np.cos(thetas[i])
+        ys[i] += d*np.sin(thetas[i])
+        thetas[i] += theta2 + noise[2, i]*turn_sigma
+
 class ParticleFilter(Node):
     """ The class that represents a Particle Filter ROS Node
         Attributes list:
@@ -72,7 +116,10 @@ class ParticleFilter(Node):
             scan_to_process: the scan that our run_loop should process next
             occupancy_field: this helper class allows you to query the map for distance to closest obstacle
             transform_helper: this helps with various transform operations (abstracting away the tf2 module)
-            particle_cloud: a list of particles representing a probability distribution over robot poses
+            xs, ys, thetas: arrays holding the x, y and yaw of each particle (relative to the map frame)
+            ws: the (unnormalized) weight of each particle
+            norm_w: the normalized weight of each particle (computed by normalize_particles)
+            particle_cloud_initialized: whether the particle arrays hold a valid particle cloud yet
             current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
                                    The pose is expressed as a list [x,y,theta] (where theta is the yaw)
             thread: this thread runs your main loop
@@ -90,12 +137,20 @@ class ParticleFilter(Node):
         self.a_thresh = math.pi/6       # the amount of angular movement before performing an update
 
         # TODO: define additional constants if needed
+        self.ray_stride = 5             # only every ray_stride-th laser reading is used to weight the particles
+        self.laser_d_max = 0.5          # obstacle distances are clipped to this value in the laser likelihood (also used for readings that fall off the map)
+        self.laser_sigma = 0.2          # the standard deviation of the laser likelihood
+
+        self.rng = np.random.default_rng()  # the random number generator used for all particle noise
 
         # pose_listener responds to selection of a new approximate robot location (for instance using rviz)
         self.create_subscription(PoseWithCovarianceStamped, 'initialpose', self.update_initial_pose, 10)
 
         # publish the current particle cloud.  This enables viewing particles in rviz.
         self.particle_pub = self.create_publisher(ParticleCloud, "particle_cloud", qos_profile_sensor_data)
+        # the message is reused for every publish (publish serializes it right away, so this is safe)
+        self._particle_cloud_msg = ParticleCloud()
+        self._particle_cloud_msg.header.frame_id = self.map_frame
 
         # laser_subscriber listens for data from the lidar
         self.create_subscription(LaserScan, self.scan_topic, self.scan_received, 10)
@@ -106,11 +161,30 @@ class ParticleFilter(Node):
         self.last_scan_timestamp = None
         # this is the current scan that our run_loop should process
         self.scan_to_process = None
-        # your particle cloud will go here
-        self.particle_cloud: list[Particle] = []
+        # your particle cloud will go here, stored as one array per particle attribute.
+        # float32 is plenty for cm level poses and halves the memory traffic of the filter updates
+        self.xs = np.zeros(self.n_particles, dtype=np.float32)
+        self.ys = np.zeros(self.n_particles, dtype=np.float32)
+        self.thetas = np.zeros(self.n_particles, dtype=np.float32)
+        self.ws = np.ones(self.n_particles, dtype=np.float32)
+        self.norm_w = np.full(self.n_particles, 1.0/self.n_particles, dtype=np.float32)
+        self.particle_cloud_initialized = False
+        # buffers that are reused across filter updates instead of allocating new arrays every update
+        self._xs2 = np.empty(self.n_particles, dtype=np.float32)       # resampled particles are written here and then
+        self._ys2 = np.empty(self.n_particles, dtype=np.float32)       # swapped with xs, ys and thetas
+        self._thetas2 = np.empty(self.n_particles, dtype=np.float32)
+        self._noise = np.empty((3, self.n_particles), dtype=np.float32)    # standard normal draws for odometry and resampling
 
         self.current_odom_xy_theta = []
         self.occupancy_field = OccupancyField(self)
+        # precompute the log likelihood -min(d, d_max)^2/sigma^2 of a laser reading ending in each map cell
+        # so that the laser update only needs a single lookup per reading
+        self.log_likelihood_grid = np.ascontiguousarray(
+            -np.minimum(self.occupancy_field.closest_occ, self.laser_d_max)**2/self.laser_sigma**2, dtype=np.float32)
+        self.off_map_log_likelihood = -self.laser_d_max**2/self.laser_sigma**2
+        self.map_origin_x = np.float32(self.occupancy_field.map.info.origin.position.x)
+        self.map_origin_y = np.float32(self.occupancy_field.map.info.origin.position.y)
+        self.map_resolution = np.float32(self.occupancy_field.map.info.resolution)
         self.transform_helper = TFHelper(self)
 
         # we are using a thread to work around single threaded execution bottleneck
@@ -165,12 +239,12 @@ class ParticleFilter(Node):
 
         if not self.current_odom_xy_theta:
             self.current_odom_xy_theta = new_odom_xy_theta
-        elif not self.particle_cloud:
+        elif not self.particle_cloud_initialized:
             # now that we have all of the necessary transforms we can update the particle cloud
-            self.initialize_particle_cloud(msg.header.stamp)
+            self.initialize_particle_cloud(msg.header.stamp, new_odom_xy_theta)
         elif self.moved_far_enough_to_update(new_odom_xy_theta):
             # we have moved far enough to do an update!
-            self.update_particles_with_odom()    # update based on odometry
+            self.update_particles_with_odom(new_odom_xy_theta)    # update based on odometry
             self.update_particles_with_laser(r, theta)   # update based on laser scan
             self.update_robot_pose()                # update robot's pose based on particles
             self.resample_particles()               # resample particles to focus on areas of high density
@@ -178,9 +252,13 @@ class ParticleFilter(Node):
         self.publish_particles(msg.header.stamp)
 
     def moved_far_enough_to_update(self, new_odom_xy_theta):
-        return math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh or \
-               math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh or \
-               math.fabs(new_odom_xy_theta[2] - self.current_odom_xy_theta[2]) > self.a_thresh
+        if math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh:
+            return True
+        if math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh:
+            return True
+        # wrap the change in yaw to [-pi, pi) so that crossing +-pi isn't mistaken for a large turn
+        delta_theta = (new_odom_xy_theta[2] - self.current_odom_xy_theta[2] + math.pi) % (2*math.pi) - math.pi
+        return math.fabs(delta_theta) > self.a_thresh
 
 
     def update_robot_pose(self):
@@ -194,17 +272,13 @@ class ParticleFilter(Node):
 
         # TODO: assign the latest pose into self.robot_pose as a geometry_msgs.Pose object
         # just to get started we will fix the robot's pose to always be at the origin
-        x_avg = 0.0
-        y_avg = 0.0
-        cos_avg = 0.0
-        sin_avg = 0.0
-        for p in self.particle_cloud:
-            x_avg += (p.x)*(p.w)
-            y_avg += (p.y)*(p.w)
-            cos_avg += np.cos(p.theta)*(p.w)
-            sin_avg += np.sin(p.theta)*(p.w)
-        theta_avg = np.arctan2(sin_avg, cos_avg)
-        print(x_avg, y_avg, theta_avg)
+        # weighted mean of the particle positions, and circular weighted mean of the particle angles
+        x_avg = float(np.dot(self.xs, self.norm_w))
+        y_avg = float(np.dot(self.ys, self.norm_w))
+        cos_avg = np.dot(np.cos(self.thetas), self.norm_w)
+        sin_avg = np.dot(np.sin(self.thetas), self.norm_w)
+        theta_avg = float(np.arctan2(sin_avg, cos_avg))
+        self.get_logger().debug("robot pose x: {0:.3f}, y: {1:.3f}, yaw: {2:.3f}".format(x_avg, y_avg, theta_avg))
         self.robot_pose = Particle(x_avg, y_avg, theta_avg, 1).as_pose()
 
         if hasattr(self, 'odom_pose'):
@@ -213,13 +287,13 @@ class ParticleFilter(Node):
         else:
             self.get_logger().warn("Can't set map->odom transform since no odom data received")
 
-    def update_particles_with_odom(self):
+    def update_particles_with_odom(self, new_odom_xy_theta):
         """ Update the particles using the newly given odometry pose.
             The function computes the value delta which is a tuple (x,y,theta)
             that indicates the change in position and angle between the odometry
             when the particles were last updated and the current odometry.
+            new_odom_xy_theta: the current odometry pose as a (x, y, theta) triple
         """
-        new_odom_xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose)
         # compute the change in x,y,theta since our last update
         if self.current_odom_xy_theta:
             old_odom_xy_theta = self.current_odom_xy_theta
@@ -234,11 +308,9 @@ class ParticleFilter(Node):
         theta1 = np.arctan2(delta[1], delta[0]) - old_odom_xy_theta[2]
         dist = np.sqrt(delta[0]**2 + delta[1]**2)
         theta2 = new_odom_xy_theta[2] - np.arctan2(delta[1], delta[0])
-        for p in self.particle_cloud:
-            p.turn(theta1+np.random.randn()*0.01)
-            p.drive(dist+np.random.randn()*0.1)
-            p.turn(theta2+np.random.randn()*0.01)
-        
+        # draw the noise for the first turn, the drive and the second turn of every particle at once
+        self.rng.standard_normal(dtype=np.float32, out=self._noise)
+        _odom_step(self.xs, self.ys, self.thetas, theta1, dist, theta2, self._noise, 0.01, 0.1)
 
         # TODO: modify particles using delta
 
@@ -252,44 +324,40 @@ class ParticleFilter(Node):
         # the number of particles to keep from the original particles, a proportion from 0-1
         amount_to_keep = 0.25
 
-        # get a list of the weights of the particles and sort them, keeping track of the indicies
-        weights = []
-        for particle in self.particle_cloud:
-            weights.append(particle.w)
-        sorted_indexes = np.argsort(weights)
-
         # get the n particles with the highest weights, n being determined by the amount_to_keep
-        worst_keeper_index = round(self.n_particles * (1-amount_to_keep))
-        best_particle_indexes  = sorted_indexes[worst_keeper_index:self.n_particles-1]
-        best_particles = [self.particle_cloud[i] for i in best_particle_indexes]
-        self.particle_cloud = best_particles
-
-        # normalize the weights of the remaining particles
-        self.normalize_particles()
+        # (argpartition only needs to separate them from the rest, not sort them)
+        n_to_keep = max(1, round(self.n_particles * amount_to_keep))
+        best_particle_indexes = np.argpartition(self.ws, -n_to_keep)[-n_to_keep:]
 
         # find the cumulative probability for that particles can be selected based on their probability with a uniformly distributed random number
-        probability = np.array([particle.norm_w for particle in self.particle_cloud])
-        cumulative_probability = probability.cumsum()
-
-        # create a new set of particles based off the old particles, prefering more likely particles
-        new_particles: list[Particle] = []
-        for i in range(self.n_particles):
-            selection_array = np.array([cumulative_probability > np.random.rand()])
-            selection_index = np.searchsorted(selection_array.flatten(), 1)
-            selected_matching_particle: Particle = self.particle_cloud[selection_index]
-            
-            position_noise = 1/12   # The spread of the x and y positions, should keep most points within 0.5 meter circle centered on mean x and y
-            angle_noise = np.pi/24  # The spread of the angles, should keep most points within 45 degrees centered on mean (22.5 degrees to either side)
-
-            # select parameters for the new partcile centered at the chosen partcile but with some noise
-            x = np.random.normal(selected_matching_particle.x, position_noise)
-            y = np.random.normal(selected_matching_particle.y, position_noise)
-            theta = np.random.normal(selected_matching_particle.theta, angle_noise)
-
-            new_particles.append(Particle(x, y, theta))
-        
-        # replace the old particles with the new particles
-        self.particle_cloud = new_particles
+        cumulative_probability = self.ws[best_particle_indexes].cumsum()
+        cumulative_probability /= cumulative_probability[-1]    # normalize the weights of the remaining particles
+
+        # create a new set of particles based off the old particles, prefering more likely particles.
+        # This uses systematic (low variance) resampling: a single random offset shared by n evenly spaced positions
+        positions = (np.arange(self.n_particles) + self.rng.random())/self.n_particles
+        selection_indexes = best_particle_indexes[np.searchsorted(cumulative_probability, positions, side='right')]
+
+        position_noise = 1/12   # The spread of the x and y positions, should keep most points within 0.5 meter circle centered on mean x and y
+        angle_noise = np.pi/24  # The spread of the angles, should keep most points within 45 degrees centered on mean (22.5 degrees to either side)
+
+        # select parameters for the new partciles centered at the chosen partciles but with some noise
+        self.rng.standard_normal(dtype=np.float32, out=self._noise)
+        self._noise[:2] *= position_noise
+        self._noise[2] *= angle_noise
+        np.take(self.xs, selection_indexes, out=self._xs2)
+        np.take(self.ys, selection_indexes, out=self._ys2)
+        np.take(self.thetas, selection_indexes, out=self._thetas2)
+        self._xs2 += self._noise[0]
+        self._ys2 += self._noise[1]
+        self._thetas2 += self._noise[2]
+
+        # replace the old particles with the new particles by swapping the buffers
+        self.xs, self._xs2 = self._xs2, self.xs
+        self.ys, self._ys2 = self._ys2, self.ys
+        self.thetas, self._thetas2 = self._thetas2, self.thetas
+        self.ws.fill(1.0)
+        self.normalize_particles()
 
         #
         # Thoughts: Should it really prefer more likely particles? It might be interesting to try
@@ -304,21 +372,20 @@ class ParticleFilter(Node):
             r: the distance readings to obstacles
             theta: the angle relative to the robot frame for each corresponding reading 
         """
-        # TODO: implement this
-        for p in self.particle_cloud:
-            for r_i, theta_i in zip(r, theta):
-                if np.isinf(r_i):
-                    continue
-                x = r_i*np.cos(p.theta + theta_i)
-                y = r_i*np.sin(p.theta + theta_i)
-                obstacle_dist = self.occupancy_field.get_closest_obstacle_distance(x,y)
-                if not np.isnan(obstacle_dist):
-                    if obstacle_dist < 0.15:
-                        p.w += 1
-
+        # only keep every ray_stride-th reading, and of those only the ones that actually hit something.
+        # The valid readings are found once per scan and gathered from r and theta with a single index array
+        r = np.asarray(r, dtype=np.float32)
+        theta = np.asarray(theta, dtype=np.float32)
+        valid = np.flatnonzero(np.isfinite(r[::self.ray_stride]))*self.ray_stride
+        r = r[valid]
+        theta = theta[valid]
+
+        # likelihood field model: w = exp(-sum(min(d, d_max)^2)/sigma^2), where readings off the map count as d_max
+        _laser_weights(self.xs, self.ys, self.thetas, r, theta,
+                       self.log_likelihood_grid, self.map_origin_x, self.map_origin_y,
+                       self.map_resolution, self.off_map_log_likelihood, self.ws)
 
         self.normalize_particles()
-        pass
 
     def update_initial_pose(self, msg):
         """ Callback function to handle re-initializing the particle filter based on a pose estimate.
@@ -333,41 +400,45 @@ class ParticleFilter(Node):
                       particle cloud around.  If this input is omitted, the odometry will be used """
         if xy_theta is None:
             xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose)
-        self.particle_cloud = []
 
         position_sigma = 1/6    # The spread of the x and y positions, should keep most points within 1 meter circle centered on mean x and y
         angle_sigma = np.pi/12  # The spread of the angles, should keep most points within 45 degrees left or right of mean
 
-        # create n_particles particles
-        for i in range(self.n_particles):
-            # sample starting values with a normal distribution
-            x = np.random.normal(xy_theta[0], position_sigma)
-            y = np.random.normal(xy_theta[1], position_sigma)
-            theta = np.random.normal(xy_theta[2], angle_sigma)
-
-            # add a particle to the particle cloud with the random parameters
-            self.particle_cloud.append(Particle(x, y, theta))
+        # create n_particles particles, sampling all of their starting values with a normal distribution at once
+        self.xs[:] = self.rng.normal(xy_theta[0], position_sigma, self.n_particles)
+        self.ys[:] = self.rng.normal(xy_theta[1], position_sigma, self.n_particles)
+        self.thetas[:] = self.rng.normal(xy_theta[2], angle_sigma, self.n_particles)
+        self.ws.fill(1.0)
+        self.particle_cloud_initialized = True
 
         self.normalize_particles()
         self.update_robot_pose()
 
     def normalize_particles(self):
         """ Make sure the particle weights define a valid distribution (i.e. sum to 1.0) """
-        # Find the sum of the weights of all of the particles
-        total_weight = 0
-        for p in self.particle_cloud:
-            total_weight += p.w
-        
-        # Divide the weight of each particle by the sum of all particle weights to normalize
-        for p in self.particle_cloud:
-            p.norm_w = p.w / total_weight
+        total_weight = self.ws.sum()
+        if total_weight > 0:
+            np.divide(self.ws, total_weight, out=self.norm_w)
+        else:
+            # every particle has weight 0, so fall back to treating them all as equally likely
+            self.norm_w.fill(1.0/self.ws.size)
 
     def publish_particles(self, timestamp):
-        msg = ParticleCloud()
-        msg.header.frame_id = self.map_frame
+        msg = self._particle_cloud_msg
         msg.header.stamp = timestamp
-        for p in self.particle_cloud:
-            msg.particles.append(Nav2Particle(pose=p.as_pose(), weight=p.w))  # type: ignore
+        if not self.particle_cloud_initialized:
+            # the particle arrays don't hold a particle cloud yet, so publish an empty one
+            msg.particles = []
+            self.particle_pub.publish(msg)
+            return
+        # the particles only have a yaw, so their quaternions are (0, 0, sin(theta/2), cos(theta/2))
+        half_thetas = 0.5*self.thetas
+        qzs = np.sin(half_thetas).tolist()
+        qws = np.cos(half_thetas).tolist()
+        msg.particles = [Nav2Particle(pose=Pose(position=Point(x=x, y=y, z=0.0),  # type: ignore
+                                                orientation=Quaternion(x=0.0, y=0.0, z=qz, w=qw)),
+                                      weight=w)
+                         for x, y, qz, qw, w in zip(self.xs.tolist(), self.ys.tolist(), qzs, qws, self.ws.tolist())]
         self.particle_pub.publish(msg)
 
     def scan_received(self, msg):